@@ -1,10 +1,17 @@
 #!/usr/bin/env python3
 
 import argparse
+import bisect
+import hashlib
 import json
+import math
 import os
+import re
+import shutil
 import subprocess
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from textwrap import dedent, indent
 
 # ANSI escape codes don't work on Windows, unless the user jumps through
@@ -21,6 +28,21 @@ except ModuleNotFoundError:
     if os.name == "nt":
         colors = False
 
+# fcntl is only available on Unix-like systems
+# Used to enlarge the pipe between FFmpeg instances on Linux
+try:
+    import fcntl
+except ModuleNotFoundError:
+    fcntl = None
+
+# orjson parses ffprobe's JSON output noticeably faster than the json module
+# Fall back to the standard library, if it isn't available
+try:
+    import orjson
+    json_loads = orjson.loads
+except ModuleNotFoundError:
+    json_loads = json.loads
+
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # Global constants
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -62,9 +84,89 @@ class Colors:
         self.RESET = ''
 
 
+# FFmpeg log levels (incl. the "stats" shortcut)
+FFMPEG_LOGLEVELS = (
+    "quiet", "panic", "fatal",
+    "error", "warning", "info",
+    "verbose", "debug", "trace",
+    "stats",
+)
+# Log levels, which let FFmpeg print its own progress information
+PROGRESS_LOGLEVELS = frozenset({"info", "verbose", "debug", "trace", "stats"})
+
+# Pixel formats supported by libvpx-vp9 (VP9) and libvpx (VP8)
+VP9_PIX_FMTS = (
+    "yuv420p", "yuva420p",
+    "yuv422p", "yuv440p", "yuv444p",
+    "yuv420p10le", "yuv422p10le", "yuv440p10le", "yuv444p10le",
+    "yuv420p12le", "yuv422p12le", "yuv440p12le", "yuv444p12le",
+    "gbrp", "gbrp10le", "gbrp12le",
+)
+VP8_PIX_FMTS = frozenset({"yuv420p", "yuva420p"})
+
+# Audio codecs that can be copied into the output (depends on the encoder)
+VORBIS_COPY_CODECS = frozenset({"vorbis"})
+OPUS_COPY_CODECS = frozenset({"vorbis", "opus"})
+
+# Input info the script actually uses (keeps ffprobe's output small)
+PROBE_ENTRIES = (
+    "format=duration"
+    ":stream=codec_type,codec_name,channels,channel_layout,bit_rate,"
+    "width,height,r_frame_rate"
+    ":stream_tags=BPS,BPS-eng"
+)
+
+# Channel layouts libopus encodes without issues (Vorbis channel order)
+# See: https://trac.ffmpeg.org/ticket/5718
+OPUS_LAYOUTS = frozenset({
+    "mono", "stereo", "3.0", "quad", "5.0", "5.1", "6.1", "7.1",
+})
+
+# Subtitle codecs, which can/can't be converted to WebVTT
+# FFmpeg only supports text->text and bitmap->bitmap conversions
+TEXT_SUB_CODECS = frozenset({
+    "ass", "ssa", "subrip", "srt", "webvtt", "mov_text", "text",
+    "microdvd", "mpl2", "jacosub", "sami", "realtext", "subviewer",
+    "subviewer1", "vplayer", "pjs", "stl", "eia_608",
+})
+IMAGE_SUB_CODECS = frozenset({
+    "hdmv_pgs_subtitle", "dvd_subtitle", "dvb_subtitle", "xsub",
+})
+
+# Audio bitrate per channel (in Kbps) based on the audio factor
+# Factors below AUDIO_FACTORS[i] get AUDIO_BITRATES[i]
+AUDIO_FACTORS = (1, 2, 3, 4, 6, 8, 28, 72, 120)
+AUDIO_BITRATES = (6, 8, 12, 16, 24, 32, 48, 64, 80, 96)
+# Sample rate needed for libvorbis at low channel bitrates
+# Channel bitrates up to SAMPLE_BITRATES[i] get SAMPLE_RATES[i]
+SAMPLE_BITRATES = (6, 12, 16)
+SAMPLE_RATES = (8000, 12000, 24000, None)
+
+# FFmpeg's time duration syntax (negative values aren't supported)
+#   [HH:]MM:SS[.m...][s|ms|us] or S+[.m...][s|ms|us]
+# MM and SS are limited to 0-59 (1-2 digits) like in FFmpeg's own parser
+# The unit applies to the whole value, not just the seconds
+# Anything else falls back to testing the string with FFmpeg
+TIME_PATTERN = re.compile(
+    r"(?:(?:(\d+):)?([0-5]?\d):([0-5]?\d(?:\.\d*)?)"
+    r"|(\d+(?:\.\d*)?))(s|ms|us)?"
+)
+TIME_UNITS = {None: 1, "s": 1, "ms": 1000, "us": 1000000}
+
+# Kernel buffer size for the pipe between FFmpeg instances (Linux only)
+# Default is 64 KiB, less than a single raw frame of most videos
+# 1 MiB is the default max. size for unprivileged processes
+PIPE_SIZE = 1 << 20
+
+# Format version of cache entries
+# Raise whenever the cached data changes (e.g. different probe entries)
+CACHE_VERSION = 1
+
 # Create objects to hold constants
 status = ExitCodes()
 size_fail = False
+# Signals running conversions to stop (i.e. after Ctrl+C)
+abort = threading.Event()
 fgcolors = Colors()
 if not colors:
     fgcolors.disable()
@@ -115,6 +217,11 @@ class DefaultOptions:
     # FFmpeg discourages >16, but VP8 encoding doesn't scale well beyond 4-6
     THREADS = 1
 
+    # How many files to convert in parallel
+    #   0 -> as many as there are CPU cores (divided by the number of threads)
+    # Output of parallel conversions will be interleaved
+    JOBS = 1
+
     # How to trim the input video (same as FFmpeg's -ss and -to)
     # Values must be in seconds (int/float) or need to be passed to valid_time()
     # Negative time values aren't supported
@@ -225,6 +332,10 @@ class DefaultOptions:
     # Prints FFmpeg commands without executing them
     DEBUG = False
 
+    # Disable the cache for probe results, durations and filter types
+    # Nothing gets read from or written to the cache directory
+    NO_CACHE = False
+
 
 class CustomArgumentParser(argparse.ArgumentParser):
     """Override ArgumentParser's automatic help text."""
@@ -250,6 +361,7 @@ class CustomArgumentParser(argparse.ArgumentParser):
           -u,  --undershoot RATIO   specify undershoot ratio (def: {self.get_default("under")})
           -i,  --iterations ITER    iterations for each bitrate mode (def: {self.get_default("iters")})
           -t,  --threads THREADS    enable multithreading
+          -j,  --jobs JOBS          convert files in parallel (def: {self.get_default("jobs")}, 0: auto)
           -ss, --start TIME         start encoding at the specified time
           -to, --end TIME           end encoding at the specified time
           -fs, --force-stereo       force stereo audio output
@@ -284,6 +396,7 @@ class CustomArgumentParser(argparse.ArgumentParser):
           --no-filter-firstpass     disable user filters during the first pass
           --ffmpeg-verbosity LEVEL  change FFmpeg command verbosity (def: {self.get_default("ffmpeg_verbosity")})
           --debug                   only print ffmpeg commands
+          --no-cache                disable the cache in '{self.get_default("cache_dir")}'
 
         All output will be saved in '{self.get_default("out_dir")}/'.
         '{self.get_default("out_dir")}/' is located in the same directory as the input.
@@ -298,10 +411,18 @@ class CustomArgumentParser(argparse.ArgumentParser):
 class FileInfo:
     """Gathers information about output settings"""
 
-    def __init__(self, in_path):
+    def __init__(self, in_path, info):
         """Initialize all properties."""
+        # Sort streams by type in a single pass
+        # Keep the stream info around, so later steps don't need to re-probe
+        streams = {"video": [], "audio": [], "subtitle": []}
+        for s in info.get('streams', []):
+            streams.setdefault(s['codec_type'], []).append(s)
+        self.v_streams = streams['video']
+        self.a_streams = streams['audio']
+
         # Subtitle-related
-        self.image_subs = out_image_subs(in_path)
+        self.image_subs = out_image_subs(in_path, streams['subtitle'])
 
         # Path-related
         self.input = in_path
@@ -309,14 +430,15 @@ class FileInfo:
         ext = f"{'mkv' if self.image_subs else 'webm'}"
         self.name = os.path.splitext(os.path.basename(self.input))[0]
         self.output = os.path.join(self.dir, f"{self.name}.{ext}")
-        self.temp = os.path.join(self.dir, f"{self.name}_{opts.suffix}.{ext}")
-
-        command = [
-            "ffprobe", "-v", "error", "-show_format", "-show_streams",
-            "-print_format", "json", self.input
-        ]
-        info = subprocess.run(command, stdout=subprocess.PIPE, check=False).stdout
-        info = json.loads(info)
+        # Base name for work files (temp. output, test encodes, 2-pass logs)
+        # Includes the input extension, so inputs with the same name don't
+        # share them (e.g. clip.mp4 and clip.mkv)
+        self.work = os.path.join(
+            self.dir, f"{os.path.basename(self.input)}_{opts.suffix}"
+        )
+        self.temp = f"{self.work}.{ext}"
+        # FFmpeg appends "-0.log" to 2-pass log names
+        self.passlog = self.work
 
         # Check input file for basic validity
         # Needs to be done here as the following steps could already fail
@@ -325,36 +447,40 @@ class FileInfo:
             return
 
         # Duration-related
-        try:
-            self.in_dur = float(info['format']['duration'])
-        except KeyError:
+        duration = info.get('format', {}).get('duration')
+        if duration:
+            self.in_dur = float(duration)
+        else:
             self.in_dur = self.brute_input_duration()
+        if self.in_dur is None:
+            err(f"{self.input}: Couldn't determine input duration!")
+            self.valid = False
+            return
         self.out_dur = self.calc_output_duration()
 
         # Audio-related
-        a_streams = [s for s in info['streams'] if s['codec_type'] == "audio"]
-        self.a_rate, self.a_list, self.a_sample = self.audio_properties(a_streams)
+        self.a_rate, self.a_list, self.a_sample = \
+            self.audio_properties(self.a_streams)
 
         # Video-related
-        self.v_rate = self.init_video_bitrate()
+        self.reset_video_bitrate()
 
-        v_stream = info['streams'][0]
+        v_stream = self.v_streams[0]
         self.in_height, self.in_fps, self.ratio = self.video_properties(v_stream)
         self.out_height = self.in_height
         self.out_fps = self.in_fps
 
     def is_valid(self, info):
         """Test for basic pitfalls that would lead to FFmpeg failure."""
-        streams = [s['codec_type'] for s in info['streams']]
         if self.image_subs and not opts.mkv_fallback:
             err(f"{self.input}: "
                 "Conversion of image-based subtitles not supported!")
             return False
-        if streams[0] != "video":
+        if not self.v_streams or info['streams'][0] is not self.v_streams[0]:
             err(f"{self.input}: "
                 "Unsupported stream order (first stream not video)!")
             return False
-        if [s for s in streams[1:] if s == "video"]:
+        if len(self.v_streams) > 1:
             err(f"{self.input}: "
                 "Files with more than one video stream not supported!")
             return False
@@ -363,22 +489,65 @@ class FileInfo:
 
     def brute_input_duration(self):
         """Brute-force detect input duration for GIFs and other images."""
-        # Encodes input as AVC (fast) and reads duration from the output
-        ffmpeg = [
-            "ffmpeg", "-y", "-v", "error", "-i", self.input, "-map", "0:v",
-            "-c:v", "libx264", "-preset", "ultrafast", "-crf", "51",
-            f"{self.name}_{opts.suffix}_.mkv"
+        # Decoding the whole input is slow, so reuse results of previous sessions
+        data = load_cache(self.input)
+        if 'duration' in data:
+            return data['duration']
+
+        duration = self.packet_duration()
+        if duration is None:
+            duration = self.decode_duration()
+        # Don't remember failures
+        if duration is None:
+            return None
+
+        data['duration'] = duration
+        save_cache(self.input, data)
+
+        return duration
+
+    def packet_duration(self):
+        """Read input duration from packet timestamps (no decoding needed)."""
+        command = [
+            "ffprobe", "-v", "error", "-select_streams", "v:0",
+            "-show_entries", "packet=pts_time,duration_time",
+            "-print_format", "csv=p=0", self.input
         ]
-        ffprobe = [
-            "ffprobe", "-v", "error", "-show_format", "-show_streams",
-            "-print_format", "json", f"{self.name}_{opts.suffix}.mkv"
+        packets = subprocess.run(command, stdout=subprocess.PIPE,
+                                 universal_newlines=True, check=False).stdout
+
+        # Some demuxers don't provide timestamps (N/A) -> no valid duration
+        try:
+            times = [[float(t) for t in p.split(",")[:2]]
+                     for p in packets.split()]
+            start = min([pts for pts, dur in times])
+            end = max([pts+dur for pts, dur in times])
+        except ValueError:
+            return None
+
+        if end <= start:
+            return None
+
+        return round(end - start, 3)
+
+    def decode_duration(self):
+        """Read input duration from FFmpeg's progress after decoding."""
+        # Decodes input without encoding or writing any output
+        command = [
+            "ffmpeg", "-v", "error", "-nostats", "-i", self.input,
+            "-map", "0:v", "-f", "null", "-progress", "pipe:1", "-"
         ]
+        progress = subprocess.run(command, stdin=subprocess.DEVNULL,
+                                  stdout=subprocess.PIPE,
+                                  universal_newlines=True, check=False).stdout
 
-        subprocess.run(ffmpeg, check=False)
-        info = subprocess.run(ffprobe, stdout=subprocess.PIPE, check=False).stdout
-        info = json.loads(info)
+        # Older FFmpeg versions only report out_time_ms (also in microseconds)
+        times = re.findall(r"out_time_(?:us|ms)=(\d+)", progress)
+        # Undecodable input or no timestamps (N/A) -> no valid duration
+        if not times or not int(times[-1]):
+            return None
 
-        return float(info['format']['duration'])
+        return int(times[-1]) / 10**6
 
     def calc_output_duration(self):
         """Calculate output duration."""
@@ -417,14 +586,7 @@ class FileInfo:
         bitrate = sum(b_list)
 
         # Downsample necessary for lower bitrates with libvorbis
-        if c_rate <= 6:
-            sample = 8000
-        elif c_rate <= 12:
-            sample = 12000
-        elif c_rate <= 16:
-            sample = 24000
-        else:
-            sample = None
+        sample = SAMPLE_RATES[bisect.bisect_left(SAMPLE_BITRATES, c_rate)]
 
         return (bitrate, b_list, sample)
 
@@ -433,18 +595,20 @@ class FileInfo:
         # If user scale/fps filter -> test encode
         # Read the effect (i.e. changed resolution / frame rate) from output
         if opts.user_scale or opts.user_fps:
+            temp = f"{self.work}.mkv"
             ffmpeg = [
                 "ffmpeg", "-y", "-v", "error", "-i", self.input, "-vframes", "1",
-                "-filter_complex", opts.f_user, f"{self.name}_{opts.suffix}.mkv"
+                "-filter_complex", opts.f_user, temp
             ]
             ffprobe = [
-                "ffprobe", "-v", "error", "-show_format", "-show_streams",
-                "-print_format", "json", f"{self.name}_{opts.suffix}.mkv"
+                "ffprobe", "-v", "error", "-select_streams", "v:0",
+                "-show_entries", "stream=width,height,r_frame_rate",
+                "-print_format", "json", temp
             ]
 
-            subprocess.run(ffmpeg, check=False)
+            subprocess.run(ffmpeg, stdin=subprocess.DEVNULL, check=False)
             info = subprocess.run(ffprobe, stdout=subprocess.PIPE, check=False).stdout
-            info = json.loads(info)
+            info = json_loads(info)
             stream = info['streams'][0]
 
         h = int(stream['height'])
@@ -466,13 +630,37 @@ class FileInfo:
 
         return bitrate
 
+    def reset_video_bitrate(self):
+        """Reset video bitrate to theoretical value and forget past attempts."""
+        self.v_rate = self.init_video_bitrate()
+        # (bitrate, size) of the previous attempt
+        self.last_attempt = None
+
     def update_video_bitrate(self, size):
         """Update video bitrate based on output file size."""
         # Size ratio dictates overall bitrate change, but audio bitrate is const
         # (v+a) = (v_old+a) * (max/curr)
         # v = v_old * (max/curr) + (max/curr - 1) * a
-        a_offset = int((opts.max_size/size - 1) * self.a_rate)
-        new_rate = int(self.v_rate * opts.max_size/size + a_offset)
+        # v = (v_old*max + (max-curr)*a) / curr
+        # Integer math, so there's only a single rounding step
+        new_rate = (self.v_rate*opts.max_size
+                    + (opts.max_size-size)*self.a_rate) // size
+
+        # Size isn't exactly proportional to the bitrate, but close to linear
+        # Use the secant through the last two attempts, if it's plausible
+        # (i.e. size grew with the bitrate and the result is positive)
+        if self.last_attempt:
+            last_rate, last_size = self.last_attempt
+            if last_rate != self.v_rate and last_size != size:
+                slope = (size-last_size) / (self.v_rate-last_rate)
+                secant_rate = int(self.v_rate + (opts.max_size-size) / slope)
+                # Nearly flat slopes (e.g. saturated quality) make the
+                # secant explode -> stay within 2x of the proportional rule
+                # Keep the proportional result, if it leaves no room at all
+                if slope > 0 and secant_rate > 0 and new_rate > 0:
+                    new_rate = max(new_rate//2, min(secant_rate, new_rate*2))
+        self.last_attempt = (self.v_rate, size)
+
         min_rate = int(self.v_rate * opts.min_bitrate_ratio)
         # Force min. decrease (% of last bitrate)
         if min_rate < new_rate < self.v_rate:
@@ -490,16 +678,21 @@ class FileInfo:
         if opts.user_scale and opts.user_fps:
             return
 
+        # Values that stay the same for all tested frame rates/heights
+        bits = self.v_rate*1000
+        ratio = self.ratio
+        bpp_thresh = opts.bpp_thresh
+
         # Perform frame rate drop
         if not opts.user_fps:
-            possible_fps = [
-                f for f in opts.fps_list
-                if self.v_rate*1000 / (f*self.ratio*self.in_height**2)
-                >= opts.bpp_thresh / 2
-            ]
-            if not possible_fps:
-                possible_fps = [opts.min_fps]
-            fps = possible_fps[0]
+            in_area = self.in_height**2
+            fps_thresh = bpp_thresh / 2
+            # fps_list is sorted in descending order -> stop at first match
+            fps = next(
+                (f for f in opts.fps_list
+                 if bits / (f*ratio*in_area) >= fps_thresh),
+                opts.min_fps
+            )
 
             # Enfore frame rate thresholds
             if fps < opts.min_fps:
@@ -512,14 +705,25 @@ class FileInfo:
 
         # Perform downscale
         if not opts.user_scale:
-            possible_heights = [
-                h for h in range(self.in_height, 0, opts.height_reduction)
-                if self.v_rate*1000 / (self.out_fps*self.ratio*h**2)
-                >= opts.bpp_thresh
-            ]
-            if not possible_heights:
-                possible_heights = [opts.min_height]
-            height = possible_heights[0]
+            in_height = self.in_height
+            fps_ratio = self.out_fps*ratio
+
+            def bpp(h):
+                return bits / (fps_ratio*h**2)
+
+            # Solve bpp(h) >= bpp_thresh for the largest possible height
+            # (in_height - n*step) instead of testing every single step
+            step = -opts.height_reduction
+            max_h = math.sqrt(bits / (fps_ratio*bpp_thresh))
+            steps = max(0, math.ceil((in_height-max_h) / step))
+            height = in_height - steps*step
+            # Correct floating point inaccuracies right at the threshold
+            while height > 0 and bpp(height) < bpp_thresh:
+                height -= step
+            while height+step <= in_height and bpp(height+step) >= bpp_thresh:
+                height += step
+            if height <= 0:
+                height = opts.min_height
 
             # Enforce height thresholds
             if height < opts.min_height:
@@ -537,6 +741,10 @@ class ConvertibleFile:
     def __init__(self, info):
         """Initialize all properties"""
         self.info = info
+        # 2-pass logs for each used filter setting (see update_filters_flags)
+        self.passlogs = {}
+        # 2-pass logs with a successfully finished 1st pass
+        self.first_passes = set()
         self.valid = self.info.valid
         if not self.valid:
             return
@@ -580,9 +788,19 @@ class ConvertibleFile:
         # Audio-related
         self.audio = self.init_audio_flags()
 
+        # Video-related
+        self.video_static = self.init_video_flags()
+        self.mode_static = self.init_mode_flags()
+
+        # Static parts of the FFmpeg commands
+        self.raw_commands = self.init_raw_commands() if opts.f_pipe else {}
+        self.command_head, self.command_streams = self.init_command()
+
         # These get updated before each encoding attempt
         self.video = []
         self.filter = []
+        self.chain_filter = []
+        self.passlog = None
 
     def init_audio_flags(self):
         """Initialize audio-related FFmpeg options."""
@@ -592,7 +810,7 @@ class ConvertibleFile:
         for s in a_streams:
             if audio_copy(self, s):
                 audio.extend([f"-c:a:{s}", "copy"])
-            elif opts.a_codec == "libopus" and opus_fallback(self.info.input, s):
+            elif opts.a_codec == "libopus" and opus_fallback(self, s):
                 audio.extend([f"-c:a:{s}", opts.fallback_codec])
                 audio.extend([f"-b:a:{s}", f"{self.info.a_list[s]}K"])
             else:
@@ -608,61 +826,83 @@ class ConvertibleFile:
 
         return audio
 
-    def update_video_flags(self, mode):
-        """Update video-related FFmpeg options."""
-        self.video = ["-c:v", opts.v_codec]
-        self.video.extend(["-deadline", "good"])
+    def init_video_flags(self):
+        """Initialize video-related FFmpeg options, which never change."""
+        video = ["-c:v", opts.v_codec]
+        video.extend(["-deadline", "good"])
         # -cpu-used defined in call_ffmpeg, since it depends on the pass
 
         # TO-DO:
         # Test how strong temporal filtering influences high quality encodes
         # Figure out how/why alpha channel support cuts short GIFs during 2-pass
-        self.video.extend(["-pix_fmt", opts.pix_fmt])
+        video.extend(["-pix_fmt", opts.pix_fmt])
 
         if opts.pix_fmt == "yuva420p":
-            self.video.extend(["-auto-alt-ref", "0"])
+            video.extend(["-auto-alt-ref", "0"])
         else:
-            self.video.extend(["-auto-alt-ref", "1",
-                               "-lag-in-frames", "25",
-                               "-arnr-maxframes", "15",
-                               "-arnr-strength", "6"])
+            video.extend(["-auto-alt-ref", "1",
+                          "-lag-in-frames", "25",
+                          "-arnr-maxframes", "15",
+                          "-arnr-strength", "6"])
 
-        self.video.extend(["-b:v", f"{self.info.v_rate}K"])
+        video.extend(["-threads", str(opts.threads)])
 
-        if opts.crf and mode in (1, 2):
-            self.video.extend(["-crf", str(opts.crf_value)])
+        # This check isn't necessary, but it avoids command bloat
+        if opts.v_codec == "libvpx-vp9" and opts.threads > 1:
+            video.extend(["-tile-columns", "6",
+                          "-tile-rows", "2",
+                          "-row-mt", "1"])
 
-        if mode == 1:
-            self.video.extend(["-qmax", str(opts.min_quality)])
-        elif mode == 3:
-            self.video.extend(["-minrate:v", f"{self.info.v_rate}K",
-                               "-maxrate:v", f"{self.info.v_rate}K",
-                               "-bufsize", f"{self.info.v_rate*5}K",
-                               "-skip_threshold", "100"])
+        return video
 
-        self.video.extend(["-threads", str(opts.threads)])
+    def init_mode_flags(self):
+        """Initialize bitrate mode-specific options, which never change."""
+        crf = ["-crf", str(opts.crf_value)] if opts.crf else []
 
-        # This check isn't necessary, but it avoids command bloat
-        if opts.v_codec == "libvpx-vp9" and opts.threads > 1:
-            self.video.extend(["-tile-columns", "6",
-                               "-tile-rows", "2",
-                               "-row-mt", "1"])
+        return {
+            1: crf + ["-qmax", str(opts.min_quality)],
+            2: crf,
+            3: ["-skip_threshold", "100"],
+        }
 
-    def update_filters_flags(self):
-        """Update filter-related FFmpeg options."""
-        f_scale = f"scale=-2:{self.info.out_height}:flags=lanczos"
-        f_fps = f"fps={self.info.out_fps}"
+    def update_video_flags(self, mode):
+        """Update video-related FFmpeg options."""
+        # Only bitrate (mode) settings change between attempts
+        self.video = self.video_static + ["-b:v", f"{self.info.v_rate}K"]
+        self.video.extend(self.mode_static[mode])
 
-        if self.info.out_height < self.info.in_height \
-           and self.info.out_fps < self.info.in_fps:
-            self.filter = ["-vf", f"{f_scale},{f_fps}"]
-        elif self.info.out_height < self.info.in_height:
-            self.filter = ["-vf", f_scale]
-        elif self.info.out_fps < self.info.in_fps:
-            self.filter = ["-vf", f_fps]
+        if mode == 3:
+            self.video.extend(["-minrate:v", f"{self.info.v_rate}K",
+                               "-maxrate:v", f"{self.info.v_rate}K",
+                               "-bufsize", f"{self.info.v_rate*5}K"])
 
-    def assemble_raw_command(self, ff_pass):
-        """Assemble custom filter-applying FFmpeg command."""
+    def update_filters_flags(self):
+        """Update filter-related FFmpeg options."""
+        filters = []
+        if self.info.out_height < self.info.in_height:
+            filters.append(f"scale=-2:{self.info.out_height}:flags=lanczos")
+        if self.info.out_fps < self.info.in_fps:
+            filters.append(f"fps={self.info.out_fps}")
+
+        self.filter = ["-vf", ",".join(filters)] if filters else []
+        # Simple user filter chains run in front of scale/fps in the same
+        # FFmpeg instance
+        self.chain_filter = ["-vf", ",".join([opts.f_user] + filters)] \
+                            if opts.f_chain else self.filter
+
+        # 1st pass stats only depend on the filtered input, not the bitrate
+        # Reuse them for all attempts with the same filters
+        key = " ".join(self.filter)
+        if key not in self.passlogs:
+            self.passlogs[key] = f"{self.info.passlog}_{len(self.passlogs)}"
+        self.passlog = self.passlogs[key]
+
+    def user_filters(self, ff_pass):
+        """Test if user filters should be applied during a pass."""
+        return not (opts.no_filter_firstpass and opts.passes == 2 and ff_pass == 1)
+
+    def init_raw_commands(self):
+        """Initialize custom filter-applying FFmpeg commands."""
         video = ["-c:v", "copy"]
         if opts.global_start or opts.f_video:
             video = ["-c:v", "rawvideo"]
@@ -671,52 +911,66 @@ class ConvertibleFile:
         if opts.global_start or opts.f_audio:
             audio = ["-c:a", "pcm_s16le"]
 
-        if opts.no_filter_firstpass and opts.passes == 2 and ff_pass == 1:
-            filters = []
-        else:
-            filters = ["-filter_complex", opts.f_user]
-
         command = ["ffmpeg", "-y", "-v", "error"]
         command.extend(self.input)
         command.extend(self.map)
         command.extend(video)
         command.extend(audio)
         command.extend(["-c:s", "copy"])
-        command.extend(filters)
-        command.extend(["-strict", "-2", "-f", "matroska", "-"])
+        output = ["-strict", "-2", "-f", "matroska", "-"]
+
+        # Index: whether to apply user filters (see user_filters())
+        return {
+            True: command + ["-filter_complex", opts.f_user] + output,
+            False: command + output,
+        }
+
+    def init_command(self):
+        """Initialize static parts of the final FFmpeg command."""
+        # No interactive commands; parallel jobs would compete for keystrokes
+        # and leave the terminal in a broken state
+        head = ["ffmpeg", "-y", "-nostdin"]
+        head.extend(self.verbosity)
+        if opts.f_pipe:
+            head.extend(["-i", "-", "-map", "0"])
+        else:
+            head.extend(self.input)
+            head.extend(self.map)
+
+        return (head, self.audio + self.subs)
 
-        return command
+    def assemble_raw_command(self, ff_pass):
+        """Assemble custom filter-applying FFmpeg command."""
+        return self.raw_commands[self.user_filters(ff_pass)]
 
     def assemble_command(self, mode, ff_pass):
         """Assemble final FFmpeg command, which creates the output file."""
         if opts.passes == 1 or mode == 3:
             output = ["-cpu-used", "0", self.info.temp]
         elif ff_pass == 1:
-            output = ["-cpu-used", "5", "-passlogfile", self.info.name,
+            output = ["-cpu-used", "5", "-passlogfile", self.passlog,
                       "-pass", "1", "-f", "null", "-"]
         elif ff_pass == 2:
-            output = ["-cpu-used", "0", "-passlogfile", self.info.name,
+            output = ["-cpu-used", "0", "-passlogfile", self.passlog,
                       "-pass", "2", self.info.temp]
 
-        command = ["ffmpeg", "-y"]
-        command.extend(self.verbosity)
-        if opts.f_user:
-            command.extend(["-i", "-", "-map", "0"])
+        if opts.f_chain and self.user_filters(ff_pass):
+            filters = self.chain_filter
         else:
-            command.extend(self.input)
-            command.extend(self.map)
-        command.extend(self.video)
-        command.extend(self.audio)
-        command.extend(self.subs)
-        command.extend(self.filter)
-        command.extend(output)
+            filters = self.filter
 
-        return command
+        # Only video settings, filters and pass settings differ between calls
+        return self.command_head + self.video + self.command_streams \
+               + filters + output
 
 
 class FileConverter:
     """Handle the conversion process of a convertible file."""
 
+    # Fixed set of size/mode trackers, which get updated after every attempt
+    __slots__ = ("curr_size", "best_size", "last_size",
+                 "min_mode", "max_mode", "mode")
+
     def __init__(self):
         """Initialize all properties."""
         self.curr_size = 0
@@ -757,15 +1011,19 @@ class FileConverter:
             self.curr_size = os.path.getsize(video.info.temp)
 
         # Test if current size is the best attempt yet
-        # True, if
-        #   -> first try (no best size yet)
-        #   -> best try too large; smaller than best try (still tries to limit)
-        #   -> best try ok; bigger than best try and smaller than max size
-        if not self.best_size \
-           or self.curr_size < self.best_size and self.best_size > opts.max_size \
-           or self.best_size < self.curr_size <= opts.max_size \
-           and self.best_size < opts.max_size:
-            self.best_size = self.curr_size
+        best, curr, limit = self.best_size, self.curr_size, opts.max_size
+        if not best:
+            # First try (no best size yet)
+            replace = True
+        elif best > limit:
+            # Best try too large; smaller than best try (still tries to limit)
+            replace = curr < best
+        else:
+            # Best try ok; bigger than best try and smaller than max size
+            replace = best < curr <= limit
+
+        if replace:
+            self.best_size = curr
             if not opts.debug:
                 os.replace(video.info.temp, video.info.output)
 
@@ -797,9 +1055,13 @@ class FileConverter:
             for i in range(1, opts.iters+1):
                 # Reset bitrate for 1st attempt of a new mode
                 if i == 1:
-                    video.info.v_rate = video.info.init_video_bitrate()
+                    video.info.reset_video_bitrate()
                 else:
+                    last_rate = video.info.v_rate
                     video.info.update_video_bitrate(self.curr_size)
+                    # Same bitrate (e.g. fallback) -> same filters and output
+                    if video.info.v_rate == last_rate:
+                        break
                 video.info.update_filters()
                 video.update_video_flags(self.mode)
                 video.update_filters_flags()
@@ -808,15 +1070,18 @@ class FileConverter:
                     f"Attempt {fgcolors.INFO}{i}{fgcolors.DEFAULT} (of {opts.iters}) | "
                     f"Height: {fgcolors.INFO}{video.info.out_height}{fgcolors.DEFAULT} | "
                     f"FPS: {fgcolors.INFO}{video.info.out_fps}{fgcolors.DEFAULT}")
-                msg(indent(dedent(f"""
-                    Video:      {' '.join(video.video)}
-                    Filters:    {' '.join(video.filter)}
-                    """), "  "),
-                    level=2)
+                # Skip assembling the detailed info, if it won't be shown
+                if opts.verbosity >= 2:
+                    msg(indent(dedent(f"""
+                        Video:      {' '.join(video.video)}
+                        Filters:    {' '.join(video.filter)}
+                        """), "  "),
+                        level=2)
 
                 call_ffmpeg(video, self.mode)
                 self.update_size(video)
-                msg(self.size_info(), level=2)
+                if opts.verbosity >= 2:
+                    msg(self.size_info(), level=2)
 
                 # Skip remaining iters, if change too small (defaul: <1%)
                 if i > 1 and self.skip_mode():
@@ -830,7 +1095,11 @@ class FileConverter:
         """Raise output size above the given lower limit."""
         for i in range(1, opts.iters+1):
             # don't re-initialize; adjust the last bitrate from limit_size()
+            last_rate = video.info.v_rate
             video.info.update_video_bitrate(self.curr_size)
+            # Same bitrate -> same filters and output
+            if video.info.v_rate == last_rate:
+                return
             video.info.update_filters()
             video.update_video_flags(self.mode)
             video.update_filters_flags()
@@ -838,15 +1107,17 @@ class FileConverter:
             msg(f"Enhance Attempt {fgcolors.INFO}{i}{fgcolors.DEFAULT} (of {opts.iters}) | "
                 f"Height: {fgcolors.INFO}{video.info.out_height}{fgcolors.DEFAULT} | "
                 f"FPS: {fgcolors.INFO}{video.info.out_fps}{fgcolors.DEFAULT}")
-            msg(indent(dedent(f"""
-                Video:      {' '.join(video.video)}
-                Filters:    {' '.join(video.filter)}
-                """), "  "),
-                level=2)
+            if opts.verbosity >= 2:
+                msg(indent(dedent(f"""
+                    Video:      {' '.join(video.video)}
+                    Filters:    {' '.join(video.filter)}
+                    """), "  "),
+                    level=2)
 
             call_ffmpeg(video, self.mode)
             self.update_size(video)
-            msg(self.size_info(), level=2)
+            if opts.verbosity >= 2:
+                msg(self.size_info(), level=2)
 
             # Skip remaining iters, if change too small (defaul: <1%)
             if self.skip_mode():
@@ -871,36 +1142,30 @@ class FileConverter:
             err(f"{video.info.output}: Still too small", color=fgcolors.WARNING)
             size_fail = True
 
-    def reset(self):
-        """Reset instance variables after conversion."""
-        self.curr_size = 0
-        self.best_size = 0
-        self.last_size = 0
-        self.mode = self.min_mode
-
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # Functions
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-def err(*args, level=0, color=fgcolors.ERROR, **kwargs):
+def err(*args, level=0, color=fgcolors.ERROR, sep=" ", end="\n"):
     """Print to stderr."""
-    if level <= opts.verbosity:
-        sys.stderr.write(color)
-        print(*args, file=sys.stderr, **kwargs)
-    sys.stderr.write(fgcolors.RESET)
-    sys.stdout.write(fgcolors.RESET)
+    if level > opts.verbosity:
+        return
 
+    # Write everything at once to not interleave with parallel jobs
+    text = sep.join([str(a) for a in args])
+    sys.stderr.write(f"{color}{text}{end}{fgcolors.RESET}")
 
-def msg(*args, level=1, color=fgcolors.DEFAULT, **kwargs):
+
+def msg(*args, level=1, color=fgcolors.DEFAULT, sep=" ", end="\n"):
     """Print to stdout based on verbosity level."""
-    if level < opts.verbosity:
-        # Print "lower-level" info bold in more verbose modes
-        sys.stdout.write(fgcolors.BOLD)
-    if level <= opts.verbosity:
-        sys.stdout.write(color)
-        print(*args, **kwargs)
-    sys.stderr.write(fgcolors.RESET)
-    sys.stdout.write(fgcolors.RESET)
+    if level > opts.verbosity:
+        return
+
+    # Print "lower-level" info bold in more verbose modes
+    bold = fgcolors.BOLD if level < opts.verbosity else ""
+    # Write everything at once to not interleave with parallel jobs
+    text = sep.join([str(a) for a in args])
+    sys.stdout.write(f"{bold}{color}{text}{end}{fgcolors.RESET}")
 
 
 def check_prereq():
@@ -931,6 +1196,19 @@ def positive_int(string):
     return value
 
 
+def non_negative_int(string):
+    """Convert string provided by argparse to a non-negative int."""
+    try:
+        value = int(string)
+        if value < 0:
+            raise ValueError
+    except ValueError:
+        error = f"invalid non-negative int value: {string}"
+        raise argparse.ArgumentTypeError(error)
+
+    return value
+
+
 def positive_float(string):
     """Convert string provided by argparse to a positive float."""
     try:
@@ -946,31 +1224,57 @@ def positive_float(string):
 
 def valid_time(string):
     """Convert string provided by argparse to time in seconds."""
+    # Parse the common syntax directly instead of spawning FFmpeg
+    match = TIME_PATTERN.fullmatch(string)
+    if match:
+        hours, minutes, seconds, plain, unit = match.groups()
+        if plain is not None:
+            sec = float(plain)
+        else:
+            sec = 3600*float(hours or 0) + 60*float(minutes) + float(seconds)
+        sec /= TIME_UNITS[unit]
+    else:
+        sec = ffmpeg_time(string)
+
+    if sec <= 0:
+        error = f"invalid positive time value: {string}"
+        raise argparse.ArgumentTypeError(error)
+
+    return sec
+
+
+def ffmpeg_time(string):
+    """Convert unusual time syntax to seconds after testing it with FFmpeg."""
     # Just test validity with FFmpeg (reasonable fast even for >1h durations)
     command = ["ffmpeg", "-v", "quiet",
                "-f", "lavfi", "-i", "anullsrc",
                "-t", string, "-c", "copy",
                "-f", "null", "-"]
-    try:
-        subprocess.check_call(command)
-    except subprocess.CalledProcessError:
-        error = f"invalid FFmpeg time syntax: {string}"
+    error = f"invalid FFmpeg time syntax: {string}"
+    result = subprocess.run(command, stdin=subprocess.DEVNULL, check=False)
+    if result.returncode != 0:
         raise argparse.ArgumentTypeError(error)
 
+    # Separate the unit suffix, which scales the whole value
+    unit = re.search(r"(ms|us|s)$", string)
+    if unit:
+        string = string[:unit.start()]
+        unit = unit.group(1)
+
     # Split into h, m and s
-    time = [float(t) for t in string.split(":")]
+    try:
+        time = [float(t) for t in string.split(":")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(error)
+
     if len(time) == 3:
         sec = 3600*time[0] + 60*time[1] + time[2]
     elif len(time) == 2:
         sec = 60*time[0] + time[1]
-    elif len(time) == 1:
+    else:
         sec = time[0]
 
-    if sec <= 0:
-        error = f"invalid positive time value: {string}"
-        raise argparse.ArgumentTypeError(error)
-
-    return sec
+    return sec / TIME_UNITS[unit]
 
 
 def valid_file(string):
@@ -986,36 +1290,91 @@ def valid_file(string):
     return path
 
 
+def filter_types():
+    """Map FFmpeg's filters to their input/output pad types (e.g. V->V)."""
+    command = ["ffmpeg", "-hide_banner", "-filters"]
+    output = subprocess.run(command, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL,
+                            universal_newlines=True, check=False).stdout
+
+    # Line format: " TSC scale             V->V       Scale the input video size."
+    types = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) >= 3 and "->" in fields[2]:
+            types[fields[1]] = fields[2]
+
+    return types
+
+
+def filter_names(filters):
+    """Extract the names of all filters used in a filtergraph."""
+    # Remove quoted arguments and link labels, as they might contain , or ;
+    filters = re.sub(r"'[^']*'|\[[^\]]*\]", "", filters)
+
+    names = []
+    for spec in re.split(r"(?<!\\)[,;]", filters):
+        name = spec.split("=", 1)[0].split("@", 1)[0].strip()
+        if name:
+            names.append(name)
+
+    return names
+
+
+def is_filter_chain(filters):
+    """Test if a filtergraph is a single chain without link labels."""
+    if not filters:
+        return False
+
+    filters = re.sub(r"'[^']*'", "", filters)
+    return ";" not in filters and "[" not in filters
+
+
 def analyze_filters(filters):
-    """Test user set filters"""
+    """Test user set filters (cached across sessions)."""
     if not filters:
         return (False, False)
 
+    # Result only depends on the filter string and the FFmpeg executable
+    ffmpeg = shutil.which("ffmpeg")
+    data = load_cache(ffmpeg) if ffmpeg else {}
+    results = data.setdefault('filters', {})
+    if filters in results:
+        return tuple(results[filters])
+
+    video, audio = test_filters(filters)
+
+    if ffmpeg:
+        results[filters] = [video, audio]
+        save_cache(ffmpeg, data)
+
+    return (video, audio)
+
+
+def test_filters(filters):
+    """Test which stream types are affected by a filtergraph."""
+    # Classify filters based on their pad types
+    # Filters with dynamic pads (N) can't be classified this way
+    types = filter_types()
+    names = filter_names(filters)
+    if all(n in types and "N" not in types[n] for n in names):
+        pads = "".join([types[n] for n in names])
+        return ("V" in pads, "A" in pads)
+
     # existing filters let copy fail
     # only crude test; stream specifiers will let it fail as well
-    command = ["ffmpeg", "-v", "quiet",
-               "-f", "lavfi", "-i", "nullsrc",
-               "-f", "lavfi", "-i", "anullsrc",
-               "-t", "1", "-c:v", "copy",
-               "-filter_complex", filters,
-               "-f", "null", "-"]
-    try:
-        subprocess.check_call(command)
-        video = False
-    except subprocess.CalledProcessError:
-        video = True
-
-    command = ["ffmpeg", "-v", "quiet",
-               "-f", "lavfi", "-i", "nullsrc",
-               "-f", "lavfi", "-i", "anullsrc",
-               "-t", "1", "-c:a", "copy",
-               "-filter_complex", filters,
-               "-f", "null", "-"]
-    try:
-        subprocess.check_call(command)
-        audio = False
-    except subprocess.CalledProcessError:
-        audio = True
+    # Both tests are independent, so run them at the same time
+    tests = [
+        subprocess.Popen(["ffmpeg", "-v", "quiet",
+                          "-f", "lavfi", "-i", "nullsrc",
+                          "-f", "lavfi", "-i", "anullsrc",
+                          "-t", "1", f"-c:{s}", "copy",
+                          "-filter_complex", filters,
+                          "-f", "null", "-"],
+                         stdin=subprocess.DEVNULL)
+        for s in ["v", "a"]
+    ]
+    video, audio = [t.wait() != 0 for t in tests]
 
     return (video, audio)
 
@@ -1047,6 +1406,8 @@ def parse_cli():
                         default=defaults.ITERS)
     parser.add_argument("-t", "--threads", type=positive_int,
                         default=defaults.THREADS)
+    parser.add_argument("-j", "--jobs", type=non_negative_int,
+                        default=defaults.JOBS)
     parser.add_argument("-ss", "--start", dest="global_start", type=valid_time,
                         default=defaults.GLOBAL_START)
     parser.add_argument("-to", "--end", dest="global_end", type=valid_time,
@@ -1074,16 +1435,8 @@ def parse_cli():
                         default=defaults.BPP_THRESH)
     parser.add_argument("--transparency", action="store_true",
                         default=defaults.TRANSPARENCY)
-    parser.add_argument(
-        "--pix-fmt", default=defaults.PIX_FMT,
-        choices=[
-            "yuv420p", "yuva420p",
-            "yuv422p", "yuv440p", "yuv444p",
-            "yuv420p10le", "yuv422p10le", "yuv440p10le", "yuv444p10le",
-            "yuv420p12le", "yuv422p12le", "yuv440p12le", "yuv444p12le",
-            "gbrp", "gbrp10le", "gbrp12le",
-        ]
-    )
+    parser.add_argument("--pix-fmt", choices=VP9_PIX_FMTS,
+                        default=defaults.PIX_FMT)
     parser.add_argument("--min-height", type=positive_int,
                         default=defaults.MIN_HEIGHT)
     parser.add_argument("--max-height", type=positive_int,
@@ -1107,16 +1460,11 @@ def parse_cli():
     # Misc. Options
     parser.add_argument("--no-filter-firstpass", action="store_true",
                         default=defaults.NO_FILTER_FIRSTPASS)
-    parser.add_argument(
-        "--ffmpeg-verbosity", default=defaults.FFMPEG_VERBOSITY,
-        choices=[
-            "quiet", "panic", "fatal",
-            "error", "warning", "info",
-            "verbose", "debug", "trace",
-            "stats",
-        ]
-    )
+    parser.add_argument("--ffmpeg-verbosity", choices=FFMPEG_LOGLEVELS,
+                        default=defaults.FFMPEG_VERBOSITY)
     parser.add_argument("--debug", action="store_true", default=defaults.DEBUG)
+    parser.add_argument("--no-cache", action="store_true",
+                        default=defaults.NO_CACHE)
 
     # Advanced User Options
     parser.set_defaults(
@@ -1132,6 +1480,7 @@ def parse_cli():
         fallback_codec="libvorbis",
         suffix="temp",
         out_dir="webm_done",
+        cache_dir=default_cache_dir(),
     )
 
     args = parser.parse_args()
@@ -1142,12 +1491,16 @@ def parse_cli():
     # Scan user filter-string for the scale and fps filter
     args.user_scale = bool(args.f_user and "scale" in args.f_user)
     args.user_fps = bool(args.f_user and "fps" in args.f_user)
+    # One job per CPU core, but don't oversubscribe with libvpx threads
+    # Debug mode asks for user input, so it must run one file at a time
+    if args.jobs == 0:
+        args.jobs = max(1, (os.cpu_count() or 1) // args.threads)
+    if args.debug:
+        args.jobs = 1
     # Set pixel format according to transparency flag
     # Makes sure that --transparency overwrites --pix-fmt
     if args.transparency:
         args.pix_fmt = "yuva420p"
-    # Check type of applied user filters
-    args.f_video, args.f_audio = analyze_filters(args.f_user)
 
     return args
 
@@ -1187,8 +1540,7 @@ def additional_checks():
         err("Max. frame rate can't be less than min. frame rate!")
         sys.exit(status.OPT)
 
-    vp8_pix_fmt = ["yuv420p", "yuva420p"]
-    if opts.v_codec == "libvpx" and opts.pix_fmt not in vp8_pix_fmt:
+    if opts.v_codec == "libvpx" and opts.pix_fmt not in VP8_PIX_FMTS:
         err(f"'{opts.pix_fmt}' isn't supported by VP8!")
         err("See 'ffmpeg -h encoder=libvpx' for more infos.",
             color=fgcolors.DEFAULT)
@@ -1197,26 +1549,7 @@ def additional_checks():
 
 def choose_audio_bitrate(factor):
     """Choose audio bitrate per channel (based on personal experience)."""
-    if factor < 1:
-        bitrate = 6
-    elif factor < 2:
-        bitrate = 8
-    elif factor < 3:
-        bitrate = 12
-    elif factor < 4:
-        bitrate = 16
-    elif factor < 6:
-        bitrate = 24
-    elif factor < 8:
-        bitrate = 32
-    elif factor < 28:
-        bitrate = 48
-    elif factor < 72:
-        bitrate = 64
-    elif factor < 120:
-        bitrate = 80
-    else:
-        bitrate = 96
+    bitrate = AUDIO_BITRATES[bisect.bisect_right(AUDIO_FACTORS, factor)]
 
     if bitrate < opts.min_audio:
         bitrate = opts.min_audio
@@ -1228,6 +1561,10 @@ def choose_audio_bitrate(factor):
 
 def print_options():
     """Print all settings for verbose output"""
+    # Don't format the whole settings overview just to discard it
+    if opts.verbosity < 2:
+        return
+
     msg("\n### Settings for the current session ###\n",
         level=2, color=fgcolors.HEADER)
 
@@ -1235,6 +1572,7 @@ def print_options():
         Paths:
           Suffix for temporary files:  {opts.suffix}
           Destination directory name:  {opts.out_dir}
+          Cache directory:             {opts.cache_dir if not opts.no_cache else None}
 
         Size:
           Max. size:                   {opts.limit} MB
@@ -1250,6 +1588,7 @@ def print_options():
           Encoder:                     {opts.v_codec}
           Passes:                      {opts.passes}
           Threads:                     {opts.threads}
+          Parallel jobs:               {opts.jobs}
           Color space:                 {opts.pix_fmt}
           Use CQ instead of VBR:       {opts.crf}
           CRF:                         {opts.crf_value}
@@ -1282,6 +1621,7 @@ def print_options():
           User filters:                {opts.f_user}
           Contains video filters:      {opts.f_video}
           Contains audio filters:      {opts.f_audio}
+          Applied via pipe:            {opts.f_pipe}
           Omit during 1st pass:        {opts.no_filter_firstpass}
           BPP threshold:               {opts.bpp_thresh} bpp
           Min. height threshold:       {opts.min_height}
@@ -1297,11 +1637,94 @@ def print_options():
           Debug mode:                  {opts.debug}"""), level=2)
 
 
+def default_cache_dir():
+    """Return the platform-specific user cache directory of the script."""
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+    else:
+        base = os.environ.get("XDG_CACHE_HOME",
+                              os.path.join(os.path.expanduser("~"), ".cache"))
+
+    return os.path.join(base, "restricted-webm")
+
+
+def cache_entry(in_path):
+    """Return cache file and validity key for a file (e.g. an input)."""
+    # Cache is only valid as long as the file stays unchanged
+    stat = os.stat(in_path)
+    key = f"{stat.st_size}-{stat.st_mtime_ns}"
+    name = hashlib.sha1(in_path.encode()).hexdigest()
+
+    return (os.path.join(opts.cache_dir, f"{name}.json"), key)
+
+
+def load_cache(in_path):
+    """Return cached info about a file (empty if outdated/missing)."""
+    if opts.no_cache:
+        return {}
+
+    cache, key = cache_entry(in_path)
+    try:
+        with open(cache, "rb") as f:
+            data = json_loads(f.read())
+        if data['key'] == key and data.get('version') == CACHE_VERSION:
+            return data
+    except (OSError, ValueError, KeyError):
+        pass
+
+    return {}
+
+
+def save_cache(in_path, data):
+    """Save info about a file in the cache."""
+    if opts.no_cache:
+        return
+
+    cache, key = cache_entry(in_path)
+    data['key'] = key
+    data['version'] = CACHE_VERSION
+
+    # A broken cache must never stop the conversion
+    # Write to a temp. file first to not leave half-written entries behind
+    try:
+        os.makedirs(opts.cache_dir, exist_ok=True)
+        temp = f"{cache}.{os.getpid()}.{threading.get_ident()}"
+        with open(temp, "w") as f:
+            json.dump(data, f)
+        os.replace(temp, cache)
+    except OSError:
+        pass
+
+
+def probe_input(in_path):
+    """Return ffprobe info about the input (cached across sessions)."""
+    data = load_cache(in_path)
+    if 'probe' in data:
+        return data['probe']
+
+    command = [
+        "ffprobe", "-v", "error", "-show_entries", PROBE_ENTRIES,
+        "-print_format", "json", in_path
+    ]
+    info = subprocess.run(command, stdout=subprocess.PIPE, check=False).stdout
+    info = json_loads(info)
+
+    # Failed probes (e.g. unreadable file) would otherwise stick around
+    if 'streams' in info:
+        data['probe'] = info
+        save_cache(in_path, data)
+
+    return info
+
+
 def resolve_path(in_path):
     """Create output dir if non-existent."""
     out_dir = os.path.join(os.path.dirname(in_path), opts.out_dir)
-    if not os.path.exists(out_dir):
+    # Parallel jobs might try to create the same dir
+    try:
         os.mkdir(out_dir)
+    except FileExistsError:
+        pass
 
 
 def audio_copy(video, stream):
@@ -1309,109 +1732,177 @@ def audio_copy(video, stream):
     if opts.global_start or opts.f_audio or opts.no_copy:
         return False
 
-    # Shorter values speed up test, but only approximate avg. bitrate
-    # 0 will copy entire audio stream -> exact
-    copy_dur = []
-    if opts.audio_test_dur:
-        copy_dur = ["-t", str(opts.audio_test_dur)]
-
-    command = ["ffmpeg", "-y", "-v", "error", "-i", video.info.input]
-    command.extend(copy_dur)
-    command.extend(["-map", f"0:a:{stream}", "-c", "copy",
-                    os.path.join(video.info.dir, f"{video.info.name}_{opts.suffix}.mkv")])
-    subprocess.run(command, check=False)
-
-    command = ["ffprobe", "-v", "error",
-               "-show_format", "-show_streams",
-               "-print_format", "json",
-               os.path.join(video.info.dir, f"{video.info.name}_{opts.suffix}.mkv")]
-    info = subprocess.run(command, stdout=subprocess.PIPE, check=False).stdout
-    info = json.loads(info)
+    if opts.a_codec == "libopus":
+        codecs = OPUS_COPY_CODECS
+    else:
+        codecs = VORBIS_COPY_CODECS
 
-    in_rate = int(info['format']['bit_rate'])
-    in_codec = info['streams'][0]['codec_name']
-    out_rate = video.info.a_list[stream]
+    # Codec is already known from the input info
+    # Only test the bitrate if the stream could be copied at all
+    if video.info.a_streams[stream]['codec_name'] not in codecs:
+        return False
+    if opts.force_copy:
+        return True
 
-    codecs = ["vorbis"]
-    if opts.a_codec == "libopus":
-        codecs.append("opus")
+    in_rate = audio_bitrate(video, stream)
+    out_rate = video.info.a_list[stream]
+    # Re-encode, if the input bitrate can't be determined
+    if in_rate is None:
+        return False
 
     # *1.05 since bitrate allocation is no exact business
-    if in_codec in codecs and (opts.force_copy or in_rate <= out_rate*1000*1.05):
-        return True
+    return bool(in_rate <= out_rate*1000*1.05)
+
+
+def audio_bitrate(video, stream):
+    """Return bitrate of an input audio stream in bps (None if unknown)."""
+    # Most containers store the stream bitrate (MKV as statistics tag)
+    info = video.info.a_streams[stream]
+    tags = info.get('tags', {})
+    for rate in (info.get('bit_rate'), tags.get('BPS'), tags.get('BPS-eng')):
+        try:
+            return int(rate)
+        except (TypeError, ValueError):
+            pass
+
+    # Otherwise sum up the packet sizes over the test duration
+    # Shorter values speed up test, but only approximate avg. bitrate
+    # 0 will read entire audio stream -> exact
+    command = ["ffprobe", "-v", "error", "-select_streams", f"a:{stream}",
+               "-show_entries", "packet=pts_time,duration_time,size",
+               "-print_format", "csv=p=0"]
+    if opts.audio_test_dur:
+        command.extend(["-read_intervals", f"%+{opts.audio_test_dur}"])
+    command.append(video.info.input)
+    packets = subprocess.run(command, stdout=subprocess.PIPE,
+                             universal_newlines=True, check=False).stdout
+
+    # Missing timestamps (N/A) -> bitrate unknown
+    try:
+        packets = [[float(v) for v in p.split(",")[:3]]
+                   for p in packets.split()]
+        start = min([pts for pts, dur, size in packets])
+        end = max([pts+dur for pts, dur, size in packets])
+    except ValueError:
+        return None
+
+    if end <= start:
+        return None
 
-    return False
+    return int(sum([size for pts, dur, size in packets])*8 / (end-start))
 
 
-def opus_fallback(in_file, stream):
+def opus_fallback(video, stream):
     """Test if audio fallback encoder is necessary"""
     if opts.force_stereo:
         return False
 
     # Certain channel configurations will throw an error
+    # Only test encode the ones not known to work
     # See: https://trac.ffmpeg.org/ticket/5718
+    if video.info.a_streams[stream].get('channel_layout') in OPUS_LAYOUTS:
+        return False
+
+    # Channel mapping errors surface during encoder init -> 1 frame is enough
     command = ["ffmpeg", "-v", "quiet",
-               "-i", in_file, "-t", "1",
+               "-i", video.info.input, "-frames:a", "1",
                "-map", "0:a:" + str(stream),
                "-c:a", "libopus", "-f", "null", "-"]
 
-    try:
-        subprocess.check_call(command)
-    except subprocess.CalledProcessError:
-        return True
-
-    return False
+    # A failing test encode is the expected result, not an exception
+    result = subprocess.run(command, stdin=subprocess.DEVNULL, check=False)
+    return result.returncode != 0
 
 
-def out_image_subs(in_file):
+def out_image_subs(in_file, sub_streams):
     """Test if output would include image-based subtitles"""
     if not opts.subs or opts.burn_subs:
         return False
 
     # FFmpeg only supports text->text and bitmap->bitmap conversions
     # bitmap->text in general is a complex topic
+    # Only test encode, if the subtitle codecs are unknown
+    codecs = {s.get('codec_name') for s in sub_streams}
+    if codecs & IMAGE_SUB_CODECS:
+        return True
+    if codecs <= TEXT_SUB_CODECS:
+        return False
+
     command = ["ffmpeg", "-v", "quiet",
                "-i", in_file, "-t", "1",
                "-map", "0:s?", "-c:s", "webvtt",
                "-f", "null", "-"]
 
-    try:
-        subprocess.check_call(command)
-    except subprocess.CalledProcessError:
-        return True
+    result = subprocess.run(command, stdin=subprocess.DEVNULL, check=False)
+    return result.returncode != 0
+
 
-    return False
+def create_pipe():
+    """Create a pipe for raw FFmpeg output (enlarged on Linux)."""
+    read_end, write_end = os.pipe()
+
+    # F_SETPIPE_SZ was only added to the fcntl module in Python 3.10
+    # Failing to resize the pipe is no reason to stop
+    if fcntl and sys.platform.startswith("linux"):
+        try:
+            fcntl.fcntl(write_end, getattr(fcntl, "F_SETPIPE_SZ", 1031),
+                        PIPE_SIZE)
+        except OSError:
+            pass
+
+    return (read_end, write_end)
 
 
 def call_ffmpeg(video, mode):
     """Run FFmpeg to create the output."""
     # Print placeholder line, if FFmpeg output is suppressed
-    if opts.ffmpeg_verbosity not in ["info", "verbose", "debug", "trace", "stats"]:
+    if opts.ffmpeg_verbosity not in PROGRESS_LOGLEVELS:
         msg("Converting...")
 
     for p in range(1, opts.passes+1):
+        if abort.is_set():
+            raise KeyboardInterrupt
         if p < opts.passes and \
-           (mode == 3 or os.path.exists(f"{video.info.name}-0.log")):
+           (mode == 3 or video.passlog in video.first_passes):
             continue
 
         if opts.debug:
-            if opts.f_user:
+            if opts.f_pipe:
                 print(' '.join(video.assemble_raw_command(p)))
             print(' '.join(video.assemble_command(mode, p)))
         else:
-            if opts.f_user:
+            if opts.f_pipe:
+                read_end, write_end = create_pipe()
+                # The raw instance reads from the input file, never stdin
                 raw_pipe = subprocess.Popen(
                     video.assemble_raw_command(p),
-                    stdout=subprocess.PIPE,
-                    bufsize=10**8
+                    stdin=subprocess.DEVNULL,
+                    stdout=write_end
                 )
-                subprocess.run(
+                encoder = subprocess.Popen(
                     video.assemble_command(mode, p),
-                    stdin=raw_pipe.stdout,
-                    check=False,
+                    stdin=read_end
                 )
+                # Only the FFmpeg instances need the pipe; closing it here
+                # lets the raw instance stop as soon as the encoder exits
+                os.close(write_end)
+                os.close(read_end)
+                returncode = encoder.wait()
+                raw_pipe.wait()
             else:
-                subprocess.run(video.assemble_command(mode, p), check=False)
+                returncode = subprocess.run(video.assemble_command(mode, p),
+                                            check=False).returncode
+
+            # FFmpeg finalizes a partial output on Ctrl+C and exits with 255
+            # The interrupt might not have reached the main thread yet
+            # Never let update_size() treat that output as a valid attempt
+            if abort.is_set() or returncode == 255 or returncode < 0:
+                abort.set()
+                raise KeyboardInterrupt
+
+            # Remember finished 1st passes instead of checking for their logs
+            if p < opts.passes and returncode == 0:
+                video.first_passes.add(video.passlog)
 
         # Always run 3rd mode (CBR) with only one pass
         if mode == 3:
@@ -1420,12 +1911,17 @@ def call_ffmpeg(video, mode):
 
 def clean(video):
     """Clean leftover file in the workspace"""
-    base = os.path.join(video.info.dir, f"{video.info.name}_{opts.suffix}")
-    for f in [f"{base}.{ext}" for ext in ["webm", "mkv"]]:
-        if os.path.exists(f):
+    leftovers = [f"{video.info.work}.{ext}" for ext in ["webm", "mkv"]]
+    if opts.passes == 2:
+        leftovers.extend([f"{log}-0.log" for log in video.passlogs.values()])
+
+    # Just try to remove files instead of testing for their existence first
+    # Avoids an additional stat call and races with other processes
+    for f in leftovers:
+        try:
             os.remove(f)
-    if opts.passes == 2 and os.path.exists(f"{video.info.name}-0.log"):
-        os.remove(f"{video.info.name}-0.log")
+        except FileNotFoundError:
+            pass
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # Main script
@@ -1436,38 +1932,89 @@ def main():
     print_options()
 
     msg("\n### Start conversion ###\n", level=2, color=fgcolors.HEADER)
-    restrictor = FileConverter()
-
-    for i, path in enumerate(opts.files, start=1):
-        resolve_path(path)
-        video = ConvertibleFile(FileInfo(path))
-        if not video.valid:
-            clean(video)
-            continue
-
-        msg(f"File {fgcolors.FILE}{i}{fgcolors.DEFAULT} (of {len(opts.files)}): "
-            f"{fgcolors.FILE}{video.info.input}{fgcolors.DEFAULT}")
-        msg(indent(dedent(f"""
-            Verbosity:  {' '.join(video.verbosity)}
-            Input/trim: {' '.join(video.input)}
-            Mapping:    {' '.join(video.map)}
-            Audio:      {' '.join(video.audio)}
-            Subtitles:  {' '.join(video.subs)}
-            Output:     {video.info.output}
-            """), "  "),
-            level=2)
 
+    # Probe all inputs up front and at once
+    # Each ffprobe call is short, so process startup would dominate otherwise
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        infos = list(executor.map(probe_input, opts.files))
+
+    # Inputs with the same name in the same directory share an output path
+    # Convert those one after another (in input order) within a single job
+    # A single job just converts all inputs in order
+    groups = {}
+    for i, (path, info) in enumerate(zip(opts.files, infos), start=1):
+        key = None
+        if opts.jobs > 1:
+            name = os.path.splitext(os.path.basename(path))[0]
+            key = os.path.normcase(os.path.join(
+                os.path.dirname(os.path.abspath(path)), opts.out_dir, name
+            ))
+        groups.setdefault(key, []).append((i, path, info))
+
+    # Conversions are independent and FFmpeg does the heavy lifting
+    # Threads are sufficient to run several of them at once
+    with ThreadPoolExecutor(max_workers=opts.jobs) as executor:
+        jobs = [executor.submit(convert_group, group)
+                for group in groups.values()]
         try:
-            restrictor.process(video)
-            restrictor.reset()
-        finally:
-            clean(video)
+            for job in jobs:
+                job.result()
+        except BaseException:
+            # Stop the whole batch on the first error (like sequential runs)
+            # Otherwise leaving the block would still wait for queued jobs
+            abort.set()
+            for job in jobs:
+                job.cancel()
+            raise
+
+
+def convert_group(group):
+    """Convert inputs sharing an output path one after another."""
+    for i, path, info in group:
+        convert(i, path, info)
+
+
+def convert(i, path, info):
+    """Convert a single input file."""
+    if abort.is_set():
+        return
+
+    resolve_path(path)
+    video = ConvertibleFile(FileInfo(path, info))
+    if not video.valid:
+        clean(video)
+        return
+
+    msg(f"File {fgcolors.FILE}{i}{fgcolors.DEFAULT} (of {len(opts.files)}): "
+        f"{fgcolors.FILE}{video.info.input}{fgcolors.DEFAULT}")
+    msg(indent(dedent(f"""
+        Verbosity:  {' '.join(video.verbosity)}
+        Input/trim: {' '.join(video.input)}
+        Mapping:    {' '.join(video.map)}
+        Audio:      {' '.join(video.audio)}
+        Subtitles:  {' '.join(video.subs)}
+        Output:     {video.info.output}
+        """), "  "),
+        level=2)
+
+    try:
+        FileConverter().process(video)
+    finally:
+        clean(video)
 
 
 # Execute main function
 if __name__ == '__main__':
     check_prereq()
     opts = parse_cli()
+    # Check type of applied user filters
+    # Done after parsing, since the cache location depends on the options
+    opts.f_video, opts.f_audio = analyze_filters(opts.f_user)
+    # Simple video filter chains can be passed via -vf, everything else
+    # gets applied by a separate FFmpeg instance and piped into the encoder
+    opts.f_chain = is_filter_chain(opts.f_user) \
+                   and opts.f_video and not opts.f_audio
+    opts.f_pipe = bool(opts.f_user) and not opts.f_chain
     additional_checks()
 
     try: